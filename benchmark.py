@@ -0,0 +1,206 @@
+"""Benchmarks for workbook generation
+
+Runs create_sheet + save for several iteration counts, sheet sets and
+output modes, each case in a fresh process so peak RSS is per case, and
+writes the results as JSON:
+
+    python benchmark.py -o bench.json
+    python benchmark.py --iterations 100 1000 --sheets all single
+    python benchmark.py --compare before.json after.json
+    python benchmark.py --check-row-xml --iterations 100 1000
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+
+# Sheet sets to benchmark, as filters over sheet_configs
+SHEET_SETS = {
+    'all': lambda name: True,
+    'leveraged': lambda name: name.endswith('-L'),
+    'zero-leverage': lambda name: name.endswith('-ZL'),
+    'single': lambda name: name == 'NTS-L',
+}
+
+# Output modes: the BuildOptions fields set for the build
+MODES = {
+    'default': {},
+    'write_only': {'write_only': True},
+    'cached_values': {'cached_values': True},
+}
+
+DEFAULT_ITERATIONS = [100, 1000, 10000]
+
+
+def count_cells(path):
+    """Number of cells in the worksheet parts of an xlsx file"""
+    with ZipFile(path) as archive:
+        return sum(archive.read(name).count(b'<c ')
+                   for name in archive.namelist() if name.startswith('xl/worksheets/'))
+
+
+def run_case(n_iter, sheet_set, mode):
+    """Build and save one workbook in this process and return its measurements"""
+    import sukuk
+    from openpyxl import Workbook
+
+    options = sukuk.BuildOptions(n_iter, **MODES[mode])
+    configs = {name: config for name, config in sukuk.sheet_configs.items() if SHEET_SETS[sheet_set](name)}
+
+    with TemporaryDirectory() as tmp:
+        output_file = os.path.join(tmp, 'bench.xlsx')
+        start = time.perf_counter()
+        wb = Workbook(write_only=options.write_only)
+        default_sheet = None if options.write_only else wb.active
+        for sheet_name, config in configs.items():
+            sukuk.create_sheet(wb, sheet_name, config, options)
+        if default_sheet is not None and default_sheet.title not in configs:
+            # As in sukuk.build: without NTS-L the default sheet stays empty
+            wb.remove(default_sheet)
+        built = time.perf_counter()
+        if options.cached_values:
+            sukuk.save_with_values(wb, output_file, configs, options)
+        else:
+            wb.save(output_file)
+        saved = time.perf_counter()
+
+        return {
+            'n_iter': n_iter,
+            'sheets': sheet_set,
+            'sheet_count': len(configs),
+            'mode': mode,
+            'build_s': round(built - start, 4),
+            'save_s': round(saved - built, 4),
+            'wall_s': round(saved - start, 4),
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                                 / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+            'cells': count_cells(output_file),
+            'file_bytes': os.path.getsize(output_file),
+        }
+
+
+def check_row_xml(n_iter, sheet_set):
+    """Worksheet parts that differ between write-only builds with and without the RowXmlCache
+
+    Returns None when the cache is not available with the installed openpyxl.
+    """
+    import sukuk
+    if not sukuk.RowXmlCache.available():
+        return None
+    configs = {name: config for name, config in sukuk.sheet_configs.items() if SHEET_SETS[sheet_set](name)}
+    cached = sukuk.build(configs, n_iter, 'bytes', write_only=True)
+    row_xml_bytes, sukuk.ROW_XML_BYTES = sukuk.ROW_XML_BYTES, 0
+    try:
+        plain = sukuk.build(configs, n_iter, 'bytes', write_only=True)
+    finally:
+        sukuk.ROW_XML_BYTES = row_xml_bytes
+
+    with ZipFile(BytesIO(cached)) as a, ZipFile(BytesIO(plain)) as b:
+        names = sorted(name for name in a.namelist() if name.startswith('xl/worksheets/'))
+        if names != sorted(name for name in b.namelist() if name.startswith('xl/worksheets/')):
+            return ['worksheet part names']
+        return [name for name in names if a.read(name) != b.read(name)]
+
+
+def run_isolated(n_iter, sheet_set, mode):
+    """Run one case in a new interpreter so its peak RSS is not shared with other cases"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(run_case, n_iter, sheet_set, mode).result()
+
+
+def environment():
+    """Versions and commit the results were measured against"""
+    import numpy
+    import openpyxl
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'openpyxl': openpyxl.__version__,
+        'numpy': numpy.__version__,
+    }
+
+
+def compare(before_file, after_file):
+    """Print the change in time, memory and size for the cases two runs share"""
+    with open(before_file) as f:
+        before = {(r['n_iter'], r['sheets'], r['mode']): r for r in json.load(f)['results']}
+    with open(after_file) as f:
+        after = {(r['n_iter'], r['sheets'], r['mode']): r for r in json.load(f)['results']}
+
+    print(f"{'n_iter':>7} {'sheets':<14} {'mode':<14} {'build':>8} {'save':>8} {'rss':>8} {'size':>8}")
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        ratios = [a[field] / b[field] if b[field] else float('nan')
+                  for field in ('build_s', 'save_s', 'peak_rss_mb', 'file_bytes')]
+        print(f"{key[0]:>7} {key[1]:<14} {key[2]:<14} " + ' '.join(f"{r:>7.2f}x" for r in ratios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, nargs='+', default=DEFAULT_ITERATIONS)
+    parser.add_argument('--sheets', nargs='+', choices=SHEET_SETS, default=['all', 'single'])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=['default', 'write_only'])
+    parser.add_argument('--repeat', type=int, default=1, help="runs per case; the fastest is kept")
+    parser.add_argument('-o', '--output', help="JSON file to write (default: stdout)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two result files instead of running")
+    parser.add_argument('--check-row-xml', action='store_true',
+                        help="check that reusing row XML leaves write-only workbooks unchanged, instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.check_row_xml:
+        failed = False
+        for n_iter in args.iterations:
+            for sheet_set in args.sheets:
+                differing = check_row_xml(n_iter, sheet_set)
+                if differing is None:
+                    print("Row XML reuse is not available with this openpyxl; nothing to check", file=sys.stderr)
+                    return
+                failed = failed or bool(differing)
+                print(f"n_iter={n_iter} sheets={sheet_set}: "
+                      + (f"differs in {', '.join(differing)}" if differing else "identical"), file=sys.stderr)
+        sys.exit(1 if failed else 0)
+
+    results = []
+    for n_iter in args.iterations:
+        for sheet_set in args.sheets:
+            for mode in args.modes:
+                runs = [run_isolated(n_iter, sheet_set, mode) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r['wall_s'])
+                print(f"n_iter={n_iter} sheets={sheet_set} mode={mode}: build {best['build_s']}s, "
+                      f"save {best['save_s']}s, peak {best['peak_rss_mb']} MB", file=sys.stderr)
+                results.append(best)
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+"""Numeric analyses built on the vectorized model in sukuk.py"""
+
+import hashlib
+
+import numpy as np
+
+from sukuk import sheet_configs, evaluate_sheet, compile_sheet, Series, SharedRows, INPUT_ROWS, MODEL_ROWS
+
+# Monte Carlo inputs and the model row each one replaces
+MC_INPUT_ROWS = {
+    'noi': 4,
+    'tax_rate': 22,
+    'ndts_rate': 26,
+    'capital_gain_rate': 27,
+    'ks': 31,
+}
+
+# Default input distributions: the workbook's ramps and constants, drawn at random
+MC_DISTRIBUTIONS = {
+    'noi': ('uniform', 10000, 52000),
+    'ks': ('uniform', 0.02, 0.44),
+    'tax_rate': ('constant', 0.35),
+    'ndts_rate': ('constant', 0.025),
+    'capital_gain_rate': ('constant', 0.03),
+}
+
+# Outputs tracked by the Monte Carlo run
+MC_OUTPUT_ROWS = {'wacc': 42, 'mvf': 51, 'eps': 53}
+
+
+def draw(rng, spec, size):
+    """Draw size samples for a distribution spec
+
+    A spec is ('constant', value) or the name of a numpy Generator method
+    followed by its parameters, e.g. ('normal', 0.35, 0.02),
+    ('triangular', 0.02, 0.1, 0.44) or ('lognormal', 10.0, 0.3).
+    """
+    kind, *params = spec
+    if kind == 'constant':
+        return np.full(size, float(params[0]))
+    return getattr(rng, kind)(*params, size=size)
+
+
+def seeded_streams(seed):
+    """Independent generators for the input draws and for each statistic's reservoir
+
+    Returns (draw_rng, stat_rng), where stat_rng(sheet_name, output) is the
+    generator of one RunningStats. Each stream is keyed by name, not by
+    spawn order, so a seeded run draws the same inputs and samples the
+    same reservoir for a strategy whichever other strategies and outputs
+    are tracked.
+    """
+    root = np.random.SeedSequence(seed)
+
+    def stream(*key):
+        digest = hashlib.sha256('\0'.join(map(str, key)).encode()).digest()
+        words = tuple(int.from_bytes(digest[k:k + 4], 'little') for k in range(0, 16, 4))
+        return np.random.default_rng(np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + words))
+
+    return stream('draws'), lambda sheet_name, output: stream('stats', sheet_name, output)
+
+
+class RunningStats:
+    """Streaming mean, variance and quantiles of one output
+
+    Batches are merged into the running mean and variance (Chan et al.),
+    and quantiles come from a fixed-size uniform reservoir sample, so
+    memory does not grow with the number of draws. NaN results (#DIV/0!)
+    are counted separately and left out of the statistics. argmin and
+    argmax are the positions of the extremes in the stream of values
+    (NaNs included), e.g. the flat index of a grid point.
+    """
+
+    __slots__ = ('count', 'nan_count', 'mean', '_m2', 'min', 'max', 'argmin', 'argmax',
+                 '_reservoir', '_filled', '_rng')
+
+    def __init__(self, reservoir_size=65536, rng=None):
+        self.count = 0
+        self.nan_count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.argmin = None
+        self.argmax = None
+        self._reservoir = np.empty(reservoir_size)
+        self._filled = 0
+        self._rng = rng if rng is not None else np.random.default_rng()
+
+    def update(self, values):
+        """Add a batch of results"""
+        values = np.asarray(values, dtype=np.float64)
+        offset = self.count + self.nan_count
+        finite = values[~np.isnan(values)]
+        self.nan_count += len(values) - len(finite)
+        n = len(finite)
+        if n == 0:
+            return
+
+        batch_mean = finite.mean()
+        batch_m2 = ((finite - batch_mean) ** 2).sum()
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += batch_m2 + delta * delta * self.count * n / total
+        if finite.min() < self.min:
+            self.min = finite.min()
+            self.argmin = offset + int(np.nanargmin(values))
+        if finite.max() > self.max:
+            self.max = finite.max()
+            self.argmax = offset + int(np.nanargmax(values))
+        self._sample(finite)
+        self.count = total
+
+    def _sample(self, values):
+        """Reservoir sampling (Algorithm R) applied to a whole batch"""
+        size = len(self._reservoir)
+        take = min(size - self._filled, len(values))
+        self._reservoir[self._filled:self._filled + take] = values[:take]
+        self._filled += take
+        rest = values[take:]
+        if len(rest) == 0:
+            return
+        # Item k of the stream replaces a random slot with probability size / (k + 1)
+        seen = self.count + take + np.arange(len(rest))
+        slots = (self._rng.random(len(rest)) * (seen + 1)).astype(np.int64)
+        keep = slots < size
+        slots, rest = slots[keep], rest[keep]
+        # Within a batch the later item wins a slot, as in the sequential algorithm
+        last = len(slots) - 1 - np.unique(slots[::-1], return_index=True)[1]
+        self._reservoir[slots[last]] = rest[last]
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantile(self, q):
+        """Estimated quantile(s) of the results seen so far"""
+        if self._filled == 0:
+            return np.full(np.shape(q), np.nan)
+        return np.quantile(self._reservoir[:self._filled], q)
+
+    def summary(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """Plain dict of the statistics"""
+        result = {
+            'count': self.count,
+            'nan_count': self.nan_count,
+            'mean': self.mean,
+            'std': self.std,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q, value in zip(quantiles, self.quantile(quantiles)):
+            result[f'q{q:g}'] = value
+        return result
+
+
+def monte_carlo(n_draws, distributions=None, seed=None, batch_size=100000,
+                configs=None, n_iter=1000, reservoir_size=65536):
+    """Evaluate every strategy on random draws of the model inputs
+
+    distributions overrides entries of MC_DISTRIBUTIONS. The extra key
+    'iteration' picks the point on the debt/sukuk/equity ramps (rows 18-20)
+    and defaults to uniform over the n_iter iterations. Draws are made in
+    batches of batch_size and shared by all strategies, so differences
+    between strategies are not blurred by sampling noise. Only running
+    statistics are kept. With a seed, the draws and each strategy's
+    statistics do not depend on which other configs are run (see
+    seeded_streams).
+
+    Returns {sheet_name: {'wacc': RunningStats, 'mvf': ..., 'eps': ...}}.
+    """
+    if configs is None:
+        configs = sheet_configs
+    specs = {'iteration': ('uniform', 0, n_iter - 1), **MC_DISTRIBUTIONS}
+    specs.update(distributions or {})
+    unknown = set(specs) - set(MC_INPUT_ROWS) - {'iteration'}
+    if unknown:
+        raise ValueError(f"Unknown Monte Carlo inputs: {sorted(unknown)}")
+
+    rng, stat_rng = seeded_streams(seed)
+    stats = {name: {output: RunningStats(reservoir_size, stat_rng(name, output)) for output in MC_OUTPUT_ROWS}
+             for name in configs}
+
+    for start in range(0, n_draws, batch_size):
+        size = min(batch_size, n_draws - start)
+        iterations = draw(rng, specs['iteration'], size)
+        inputs = {row: draw(rng, specs[key], size) for key, row in MC_INPUT_ROWS.items()}
+        shared = SharedRows()
+        for sheet_name, config in configs.items():
+            rows = evaluate_sheet(sheet_name, config, n_iter, inputs=inputs, iterations=iterations,
+                                  rows=list(MC_OUTPUT_ROWS.values()), shared=shared)
+            for output, row in MC_OUTPUT_ROWS.items():
+                stats[sheet_name][output].update(rows[row])
+    return stats
+
+
+# Sensitivity table: outputs (WACC, MVF, MVF with shields, EPS) and the input
+# rows they are differentiated by (starting balances 18-20 and the rates)
+SENSITIVITY_OUTPUTS = [42, 43, 51, 53]
+SENSITIVITY_INPUTS = [18, 19, 20, 22, 24, 25, 26, 27, 28, 29, 30, 31]
+
+
+def sensitivities(n_iter=1000, configs=None, outputs=None, inputs=None, iterations=None, step=1e-20):
+    """Partial derivatives of output rows with respect to input rows
+
+    Covers every iteration (or the given iteration positions) of every
+    strategy. Uses the complex-step method: each input gets an imaginary
+    perturbation of size step in its own block of one batched evaluation
+    per strategy. The derivatives are therefore exact to rounding, without
+    the cancellation error of finite differences. Rows 18-20 are
+    differentiated by their starting balance (column I), the other inputs
+    by the value of the whole row.
+
+    Returns {sheet_name: {output_row: {input_row: array}}}, NaN where the
+    output is #DIV/0!. For example the change in MVF (row 51) of RTS-L per
+    unit of tax rate is sensitivities()['RTS-L'][51][22].
+    """
+    if configs is None:
+        configs = sheet_configs
+    outputs = list(SENSITIVITY_OUTPUTS if outputs is None else outputs)
+    inputs = list(SENSITIVITY_INPUTS if inputs is None else inputs)
+    unknown = set(inputs) - set(INPUT_ROWS)
+    if unknown:
+        raise ValueError(f"Rows {sorted(unknown)} are not inputs; inputs are rows {INPUT_ROWS}")
+    i = np.arange(n_iter, dtype=np.float64) if iterations is None else np.asarray(iterations, dtype=np.float64)
+    n, k = len(i), len(inputs)
+
+    result = {}
+    for sheet_name, config in configs.items():
+        base = evaluate_sheet(sheet_name, config, n_iter, iterations=i, rows=inputs)
+        fills = {row: fill for row, _, fill in compile_sheet(sheet_name, config).rows}
+        perturbed = {}
+        for j, row in enumerate(inputs):
+            # A series without a step has only its starting cell, the rest of the row is blank
+            fill = fills.get(row)
+            direction = (i == 0) if isinstance(fill, Series) and fill.step is None else 1.0
+            values = np.tile(base[row], k).astype(np.complex128)
+            values[j * n:(j + 1) * n] += 1j * step * direction
+            perturbed[row] = values
+        rows = evaluate_sheet(sheet_name, config, n_iter, inputs=perturbed,
+                              iterations=np.tile(i, k), rows=outputs)
+        result[sheet_name] = {
+            output: dict(zip(inputs, rows[output].imag.reshape(k, n) / step))
+            for output in outputs
+        }
+    return result
+
+
+# Grid sweep axes beyond 'iteration': input rows set directly, and the
+# per-iteration steps of the equity, debt and sukuk series (rows 18-20)
+SWEEP_INPUT_ROWS = dict(MC_INPUT_ROWS)
+SWEEP_STEP_ROWS = {'equity_step': 18, 'debt_step': 19, 'sukuk_step': 20}
+
+# Capital amounts optimize searches over; equity (row 18) takes the rest of total assets
+OPTIMIZE_CAPITAL_ROWS = {'debt': 19, 'sukuk': 20}
+
+# Rough working memory per grid point and strategy: the model rows plus temporaries
+_BYTES_PER_POINT = 2 * 8 * len(MODEL_ROWS)
+
+
+def _grid_axes(axes, n_iter):
+    """Axis values as float arrays, with 'iteration' over all n_iter iterations unless given"""
+    axes = {name: np.atleast_1d(np.asarray(values, dtype=np.float64)) for name, values in axes.items()}
+    axes.setdefault('iteration', np.arange(n_iter, dtype=np.float64))
+    unknown = set(axes) - set(SWEEP_INPUT_ROWS) - set(SWEEP_STEP_ROWS) - {'iteration'}
+    if unknown:
+        raise ValueError(f"Unknown sweep axes: {sorted(unknown)}")
+    return axes
+
+
+def grid_point(axes, index, n_iter=1000):
+    """Axis values of the point at flat index in a grid_sweep over axes"""
+    axes = _grid_axes(axes, n_iter)
+    position = np.unravel_index(index, tuple(len(values) for values in axes.values()))
+    return {name: float(values[k]) for (name, values), k in zip(axes.items(), position)}
+
+
+def grid_sweep(axes, outputs=None, configs=None, n_iter=1000, memory_budget=256 * 2**20,
+               out=None, reservoir_size=65536, seed=None, dtype=np.float64):
+    """Evaluate every strategy over the Cartesian product of parameter axes
+
+    axes maps axis names to value lists: 'iteration', the inputs of
+    MC_INPUT_ROWS (e.g. 'tax_rate') and the series steps of
+    SWEEP_STEP_ROWS (e.g. 'debt_step': [-60, -40, -20]). 'iteration' is
+    added over all n_iter iterations when missing, since the steps act
+    through it. Sheets whose debt row has no series (-ZL) ignore
+    'debt_step'.
+
+    The grid is walked in flat (C-order) chunks sized to memory_budget
+    bytes and reduced as it goes into RunningStats per strategy and
+    output (outputs default to MC_OUTPUT_ROWS). argmin/argmax are flat grid
+    indices; see grid_point. Each statistic samples its quantile
+    reservoir from its own stream of seed (see seeded_streams). If out is a path, every value is also written
+    to a memory-mapped .npy array of shape (strategies, outputs, *grid),
+    of dtype (np.float32 halves the file; see evaluate_results for the
+    precision).
+
+    Returns {sheet_name: {output: RunningStats}}.
+    """
+    if configs is None:
+        configs = sheet_configs
+    if outputs is None:
+        outputs = MC_OUTPUT_ROWS
+    axes = _grid_axes(axes, n_iter)
+    shape = tuple(len(values) for values in axes.values())
+    total = int(np.prod(shape))
+    # The SharedRows memo keeps every strategy's rows alive until the chunk ends
+    chunk = max(1, memory_budget // (_BYTES_PER_POINT * len(configs)))
+
+    _, stat_rng = seeded_streams(seed)
+    stats = {name: {output: RunningStats(reservoir_size, stat_rng(name, output)) for output in outputs}
+             for name in configs}
+    values = None
+    if out is not None:
+        values = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                           shape=(len(configs), len(outputs)) + shape)
+    series = {name: {row: fill for row, _, fill in compile_sheet(name, config).rows
+                     if row in SWEEP_STEP_ROWS.values()}
+              for name, config in configs.items()}
+
+    for start in range(0, total, chunk):
+        stop = min(start + chunk, total)
+        position = np.unravel_index(np.arange(start, stop), shape)
+        point = {name: axis[k] for (name, axis), k in zip(axes.items(), position)}
+        iterations = point['iteration']
+        inputs = {SWEEP_INPUT_ROWS[name]: point[name] for name in point if name in SWEEP_INPUT_ROWS}
+        shared = SharedRows()
+
+        for s, (sheet_name, config) in enumerate(configs.items()):
+            sheet_inputs = dict(inputs)
+            for name, row in SWEEP_STEP_ROWS.items():
+                fill = series[sheet_name].get(row)
+                if name in point and isinstance(fill, Series) and fill.step is not None:
+                    sheet_inputs[row] = fill.first + point[name] * iterations
+            rows = evaluate_sheet(sheet_name, config, n_iter, inputs=sheet_inputs,
+                                  iterations=iterations, rows=list(outputs.values()), shared=shared)
+            for o, (output, row) in enumerate(outputs.items()):
+                stats[sheet_name][output].update(rows[row])
+                if values is not None:
+                    values[s, o].reshape(-1)[start:stop] = rows[row]
+
+    if values is not None:
+        values.flush()
+    return stats
+
+
+def optimize(objective='mvf', maximize=None, variables=None, fixed=None, configs=None,
+             n_iter=1000, grid=33, points=9, candidates=4, tol=1e-10):
+    """Find the best point of every strategy over continuous inputs
+
+    objective is an output name of MC_OUTPUT_ROWS or a model row; it is
+    maximized unless it is WACC (row 42), or as maximize says. variables
+    maps the capital amounts of OPTIMIZE_CAPITAL_ROWS ('debt', 'sukuk';
+    equity takes the rest of the sheet's total assets, which stay fixed)
+    and inputs of SWEEP_INPUT_ROWS to (low, high) bounds, by default debt
+    and sukuk from zero to total assets and ks over its ramp, less any
+    that are fixed. Sheets whose
+    debt row has no series (-ZL) keep their debt at zero. fixed holds
+    inputs at a value, e.g. {'tax_rate': 0.30}. Everything else stays at
+    the middle of the workbook's ramps, so NOI is fixed at 31000 unless
+    it is a variable or fixed.
+
+    The search is a vectorized bracketing: a coarse grid of grid points per
+    variable picks the best candidates, then each candidate box is shrunk
+    around its best point on a points-per-variable grid until it is
+    narrower than tol times the bounds. Every level is one batched
+    evaluation per strategy. Mixes with negative equity are skipped.
+
+    Returns {sheet_name: {'value': ..., 'point': {variable: ...},
+    'weights': {'equity': ..., 'debt': ..., 'sukuk': ...}}}.
+    """
+    if configs is None:
+        configs = sheet_configs
+    row = MC_OUTPUT_ROWS.get(objective, objective)
+    if maximize is None:
+        maximize = row != 42
+    fixed = dict(fixed or {})
+    unknown = (set(variables or {}) | set(fixed)) - set(SWEEP_INPUT_ROWS) - set(OPTIMIZE_CAPITAL_ROWS)
+    if unknown:
+        raise ValueError(f"Unknown optimizer inputs: {sorted(unknown)}")
+    middle = np.array([(n_iter - 1) / 2])
+
+    def unit_grid(n, k):
+        if not k:
+            return np.zeros((1, 0))
+        axes = np.meshgrid(*[np.linspace(0, 1, n)] * k, indexing='ij')
+        return np.stack(axes, axis=-1).reshape(-1, k)
+
+    result = {}
+    for sheet_name, config in configs.items():
+        fills = {r: fill for r, _, fill in compile_sheet(sheet_name, config).rows}
+        base = evaluate_sheet(sheet_name, config, n_iter, iterations=middle, rows=[18, 19, 20, 21])
+        total = float(base[21][0])
+        bounds = variables
+        if bounds is None:
+            ks = fills[SWEEP_INPUT_ROWS['ks']]
+            bounds = {name: value for name, value in
+                      {'debt': (0, total), 'sukuk': (0, total), 'ks': (ks.start, ks.end)}.items()
+                      if name not in fixed}
+        sheet_fixed = dict(fixed)
+        if not (isinstance(fills.get(19), Series) and fills[19].step is not None):
+            bounds = {name: value for name, value in bounds.items() if name != 'debt'}
+            sheet_fixed.pop('debt', None)
+
+        names = list(bounds)
+        low = np.array([bounds[name][0] for name in names], dtype=np.float64)
+        high = np.array([bounds[name][1] for name in names], dtype=np.float64)
+
+        def evaluate(x, rows):
+            point = dict(sheet_fixed, **dict(zip(names, x.T)))
+            inputs = {SWEEP_INPUT_ROWS[name]: value for name, value in point.items() if name in SWEEP_INPUT_ROWS}
+            debt = point.get('debt', base[19][0])
+            sukuk = point.get('sukuk', base[20][0])
+            equity = np.broadcast_to(total - debt - sukuk, len(x))
+            inputs.update({18: equity, 19: debt, 20: sukuk})
+            iterations = np.broadcast_to(middle, len(x))
+            return evaluate_sheet(sheet_name, config, n_iter, inputs=inputs, iterations=iterations, rows=rows), equity
+
+        def score(x):
+            rows, equity = evaluate(x, [row])
+            values = rows[row] if maximize else -rows[row]
+            return np.where(np.isnan(values) | (equity < 0), -np.inf, values)
+
+        x = low + unit_grid(grid, len(names)) * (high - low)
+        s = score(x)
+        best = np.argsort(-s, kind='stable')[:candidates]
+        center, best_score = x[best], s[best]
+        half_width = np.broadcast_to((high - low) / (grid - 1), center.shape)
+        fine = unit_grid(points, len(names))
+
+        while np.any(half_width > tol * (high - low)):
+            box_low = np.maximum(center - half_width, low)
+            box_high = np.minimum(center + half_width, high)
+            x = box_low[:, None, :] + fine[None] * (box_high - box_low)[:, None, :]
+            s = score(x.reshape(-1, len(names))).reshape(len(center), -1)
+            pick = s.argmax(axis=1)
+            improved = s[np.arange(len(center)), pick] >= best_score
+            center = np.where(improved[:, None], x[np.arange(len(center)), pick], center)
+            best_score = np.maximum(best_score, s[np.arange(len(center)), pick])
+            half_width = (box_high - box_low) / (points - 1)
+
+        winner = center[[np.argmax(best_score)]]
+        rows, _ = evaluate(winner, [row, 39, 40, 41])
+        result[sheet_name] = {
+            'value': float(rows[row][0]),
+            'point': {name: float(value) for name, value in zip(names, winner[0])},
+            'weights': {'equity': float(rows[41][0]), 'debt': float(rows[39][0]), 'sukuk': float(rows[40][0])},
+        }
+    return result
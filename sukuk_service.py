@@ -0,0 +1,351 @@
+"""Local HTTP service for model scenarios
+
+Serves evaluated rows (JSON or Arrow) and generated workbooks over HTTP,
+so tools can ask for a scenario instead of running sukuk.py and parsing
+the workbook:
+
+    python sukuk_service.py --port 8050 --workers 4
+
+    GET  /rows?sheets=NTS-L,RTS-L&n_iter=1000&rows=42,51&tax_rate=0.30
+    GET  /rows?n_iter=1000&format=arrow
+    POST /rows        {"sheets": ["RTS-L"], "n_iter": 1000, "row_31": 0.12}
+    GET  /workbook?n_iter=200&shared_formulas=1
+    GET  /health
+
+Builds run in a process pool, so a slow workbook does not hold up other
+requests. Responses are kept in an LRU cache bounded by their total size
+and keyed by a hash of the normalized parameters; a repeated request is
+answered from memory, and identical requests that arrive while the first
+is still building wait for that build instead of starting their own.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from sukuk import sheet_configs, evaluate_sheet, build, BuildOptions, _arrow_table, INPUT_ROWS, MODEL_ROWS
+from sukuk_analysis import MC_INPUT_ROWS
+
+# Largest iteration count a request may ask for
+MAX_ITERATIONS = 100000
+
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 20
+
+# Input overrides by name, besides row_N for any of INPUT_ROWS
+SERVICE_INPUTS = dict(MC_INPUT_ROWS)
+
+# Workbook layout parameters, passed on to build as BuildOptions fields
+WORKBOOK_OPTIONS = [field for field in BuildOptions._fields if field != 'n_iter']
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def _flag(value):
+    """A boolean parameter from JSON or a query string ('1', 'true', 'yes')"""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def _list(value):
+    """A list parameter from JSON or a comma-separated query string"""
+    return value.split(',') if isinstance(value, str) else list(value)
+
+def scenario_params(kind, query):
+    """Normalize request parameters into the dict that keys the cache and drives render
+
+    query maps parameter names to values, as parsed from a query string
+    (all strings) or a JSON body. Raises ValueError for anything the model
+    cannot serve.
+    """
+    query = dict(query)
+    sheets = _list(query.pop('sheets', list(sheet_configs)))
+    unknown = [name for name in sheets if name not in sheet_configs]
+    if unknown:
+        raise ValueError(f"Unknown sheets {unknown}; sheets are {list(sheet_configs)}")
+    n_iter = int(query.pop('n_iter', 1000))
+    if not 2 <= n_iter <= MAX_ITERATIONS:
+        raise ValueError(f"n_iter must be between 2 and {MAX_ITERATIONS}")
+    params = {'kind': kind, 'sheets': list(dict.fromkeys(sheets)), 'n_iter': n_iter}
+
+    if kind == 'workbook':
+        params['options'] = {field: _flag(query.pop(field)) for field in WORKBOOK_OPTIONS if field in query}
+        if query:
+            raise ValueError(f"Unknown workbook parameters {sorted(query)}; the workbook holds the "
+                             f"model's own inputs, so overrides apply to /rows only")
+        return params
+
+    rows = query.pop('rows', None)
+    rows = MODEL_ROWS if rows is None else sorted({int(row) for row in _list(rows)})
+    unknown = sorted(set(rows) - set(MODEL_ROWS))
+    if unknown:
+        raise ValueError(f"Rows {unknown} are not model rows; see MODEL_ROWS")
+    fmt = query.pop('format', 'json')
+    if fmt not in ('json', 'arrow'):
+        raise ValueError("format is 'json' or 'arrow'")
+
+    inputs = {}
+    for name, value in query.items():
+        if name in SERVICE_INPUTS:
+            row = SERVICE_INPUTS[name]
+        elif name.startswith('row_') and name[4:].isdigit() and int(name[4:]) in INPUT_ROWS:
+            row = int(name[4:])
+        else:
+            raise ValueError(f"Unknown parameter {name!r}; inputs are {sorted(SERVICE_INPUTS)} "
+                             f"or row_N for N in {INPUT_ROWS}")
+        value = float(value)
+        # NaN and infinity would come back in the JSON response, which has no literal for them
+        if not math.isfinite(value):
+            raise ValueError(f"{name} must be a finite number, not {value}")
+        inputs[str(row)] = value
+    params.update(rows=list(rows), format=fmt, inputs=dict(sorted(inputs.items(), key=lambda item: int(item[0]))))
+    return params
+
+def params_key(params):
+    """Hash of normalized parameters, the cache key"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def render(params):
+    """Compute one response body; runs in a worker process
+
+    Returns (content_type, body bytes).
+    """
+    configs = {name: sheet_configs[name] for name in params['sheets']}
+    n_iter = params['n_iter']
+    if params['kind'] == 'workbook':
+        return CONTENT_TYPES['xlsx'], build(configs, n_iter, 'bytes', **params['options'])
+
+    rows = params['rows']
+    inputs = {int(row): value for row, value in params['inputs'].items()}
+    results = {name: evaluate_sheet(name, config, n_iter, inputs=inputs, rows=rows)
+               for name, config in configs.items()}
+
+    if params['format'] == 'arrow':
+        import pyarrow as pa
+        values = np.array([[results[name][row] for name in configs] for row in rows])
+        table = _arrow_table(values, list(configs), n_iter, rows)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        return CONTENT_TYPES['arrow'], sink.getvalue().to_pybytes()
+
+    # #DIV/0! results are NaN, which JSON has no literal for
+    sheets = {name: {str(row): [None if x != x else x for x in values[row].tolist()] for row in rows}
+              for name, values in results.items()}
+    body = json.dumps({'n_iter': n_iter, 'inputs': params['inputs'], 'sheets': sheets})
+    return CONTENT_TYPES['json'], body.encode()
+
+
+class ResultCache:
+    """LRU cache of response bodies bounded by their total size in bytes
+
+    Entries are (content_type, body). Adding an entry evicts the least
+    recently used ones until the total fits in max_bytes; a single body
+    larger than max_bytes is not kept.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        size = len(entry[1])
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key)[1])
+        self._entries[key] = entry
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted[1])
+
+    def stats(self):
+        return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class ScenarioService:
+    """asyncio HTTP server answering scenario requests from a worker pool and a ResultCache"""
+
+    def __init__(self, workers=None, cache_bytes=256 * 2**20):
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.cache = ResultCache(cache_bytes)
+        self._pending = {}
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8050):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.pool.shutdown(cancel_futures=True)
+
+    async def result(self, params):
+        """(content_type, body, source) for params, from the cache, a running build or a new one"""
+        key = params_key(params)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry + ('hit',)
+        future = self._pending.get(key)
+        source = 'shared' if future is not None else 'miss'
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.pool, render, params)
+            self._pending[key] = future
+
+            def finished(future):
+                del self._pending[key]
+                if not future.cancelled() and future.exception() is None:
+                    self.cache.put(key, future.result())
+            future.add_done_callback(finished)
+        # Shielded so a client that disconnects does not cancel the build for the others waiting on it
+        return await asyncio.shield(future) + (source,)
+
+    async def respond(self, method, target, body):
+        """(status, content_type, body, headers) for one request"""
+        url = urlsplit(target)
+        kind = url.path.strip('/')
+        if kind == 'health':
+            return 200, CONTENT_TYPES['json'], json.dumps({'status': 'ok', 'cache': self.cache.stats()}).encode(), {}
+        if kind not in ('rows', 'workbook'):
+            return _error(404, f"No such endpoint {url.path}; use /rows, /workbook or /health")
+        if method == 'GET':
+            query = dict(parse_qsl(url.query))
+        elif method == 'POST':
+            try:
+                query = json.loads(body or b'{}')
+            except ValueError as e:
+                return _error(400, f"Request body is not JSON: {e}")
+            if not isinstance(query, dict):
+                return _error(400, "Request body must be a JSON object")
+        else:
+            return _error(405, "Use GET or POST")
+        try:
+            params = scenario_params(kind, query)
+            content_type, payload, source = await self.result(params)
+        except (ValueError, TypeError) as e:
+            return _error(400, str(e))
+        except ImportError as e:
+            return _error(500, str(e))
+        headers = {'X-Cache': source}
+        if kind == 'workbook':
+            headers['Content-Disposition'] = f'attachment; filename="sukuk_analysis_{params["n_iter"]}_iterations.xlsx"'
+        return 200, content_type, payload, headers
+
+    async def handle(self, reader, writer):
+        """Serve the requests of one connection (HTTP/1.1, kept alive unless closed)"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await _send(writer, *_error(400, "Malformed request line"), keep_alive=False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await _send(writer, *_error(400, "Content-Length must be a non-negative integer"),
+                                keep_alive=False)
+                    break
+                if length > MAX_BODY:
+                    await _send(writer, *_error(413, f"Request bodies are limited to {MAX_BODY} bytes"), keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                try:
+                    response = await self.respond(method, target, body)
+                except Exception as e:
+                    response = _error(500, f"{type(e).__name__}: {e}")
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+                await _send(writer, *response, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _error(status, message):
+    return status, CONTENT_TYPES['json'], json.dumps({'error': message}).encode(), {}
+
+async def _send(writer, status, content_type, body, headers, keep_alive=True):
+    head = [f'HTTP/1.1 {status} {REASONS[status]}', f'Content-Type: {content_type}',
+            f'Content-Length: {len(body)}', f'Connection: {"keep-alive" if keep_alive else "close"}']
+    head += [f'{name}: {value}' for name, value in headers.items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+
+async def serve(host='127.0.0.1', port=8050, workers=None, cache_bytes=256 * 2**20):
+    """Run a ScenarioService until cancelled"""
+    service = ScenarioService(workers, cache_bytes)
+    server = await service.start(host, port)
+    print(f"Serving sukuk scenarios on http://{host}:{port}/ (rows, workbook, health)", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve sukuk model scenarios over HTTP")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--workers', type=int, help="worker processes for builds (default: CPU count)")
+    parser.add_argument('--cache-mb', type=float, default=256, help="size of the response cache in MB")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.workers, int(args.cache_mb * 2**20)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
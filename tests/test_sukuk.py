@@ -0,0 +1,34 @@
+from io import BytesIO
+from zipfile import ZipFile
+
+import pytest
+
+from sukuk import BuildOptions, build, evaluate_results, sheet_configs, verify_workbook
+
+
+def test_sheet_results_contains_row_names():
+    results = evaluate_results(10, rows=[42, 51])
+    assert 'wacc' in results['RTS-L']
+    assert 42 in results['RTS-L']
+    assert 'eps' not in results['RTS-L']
+    assert [42] not in results['RTS-L']
+
+
+def test_build_rejects_fewer_than_two_iterations():
+    with pytest.raises(ValueError, match='at least 2 iterations'):
+        build(n_iter=1)
+
+
+def test_verify_reports_shared_formula_without_master(tmp_path):
+    configs = {'RTS-L': sheet_configs['RTS-L']}
+    data = build(configs, 10, 'bytes', shared_formulas=True)
+    path = tmp_path / 'edited.xlsx'
+    with ZipFile(BytesIO(data)) as src, ZipFile(path, 'w') as dst:
+        for item in src.infolist():
+            part = src.read(item.filename)
+            if item.filename == 'xl/worksheets/sheet1.xml':
+                part = part.replace(b'<f t="shared" si="0" />', b'<f t="shared" si="99" />', 1)
+            dst.writestr(item, part)
+    divergence = verify_workbook(path, configs, BuildOptions(10, shared_formulas=True))['RTS-L']
+    assert divergence.cell == 'J5'
+    assert 'no master' in divergence.found
@@ -0,0 +1,20 @@
+import numpy as np
+
+from sukuk import sheet_configs
+from sukuk_analysis import monte_carlo, grid_sweep
+
+
+def test_monte_carlo_seeded_strategy_does_not_depend_on_other_configs():
+    alone = monte_carlo(30000, seed=1, batch_size=10000, configs={'RTS-L': sheet_configs['RTS-L']},
+                        reservoir_size=1000)
+    together = monte_carlo(30000, seed=1, batch_size=10000, reservoir_size=1000)
+    for output, stats in alone['RTS-L'].items():
+        assert stats.summary() == together['RTS-L'][output].summary()
+
+
+def test_grid_sweep_seeded_quantiles_do_not_depend_on_other_configs():
+    axes = {'ks': np.linspace(0.02, 0.44, 50), 'iteration': np.arange(0, 1000, 10)}
+    alone = grid_sweep(axes, configs={'RTS-L': sheet_configs['RTS-L']}, reservoir_size=500, seed=3)
+    together = grid_sweep(axes, reservoir_size=500, seed=3)
+    for output, stats in alone['RTS-L'].items():
+        assert stats.summary() == together['RTS-L'][output].summary()
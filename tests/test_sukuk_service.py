@@ -0,0 +1,29 @@
+import asyncio
+import json
+
+import pytest
+
+from sukuk_service import ScenarioService
+
+
+async def _request(raw):
+    service = ScenarioService(workers=1)
+    server = await service.start(port=0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(raw)
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 10)
+        writer.close()
+        return response
+    finally:
+        await service.close()
+
+
+@pytest.mark.parametrize('length', [b'abc', b'-5'])
+def test_bad_content_length_is_a_400(length):
+    response = asyncio.run(_request(b'POST /rows HTTP/1.1\r\nContent-Length: ' + length + b'\r\n\r\n{}'))
+    head, _, body = response.partition(b'\r\n\r\n')
+    assert head.startswith(b'HTTP/1.1 400 ')
+    assert 'Content-Length' in json.loads(body)['error']